@@ -0,0 +1,367 @@
+from __future__ import annotations
+from typing import List, Dict, Optional, Iterable, TypedDict, get_args
+import csv
+import json
+import os
+import hashlib
+import math
+import datetime
+import logging
+from firebase_admin import auth, firestore
+import firebase_admin.exceptions
+
+from hedge_fund_models import db, User, Account, Transaction, AccountType
+
+# Firestore rejects batches with more than 500 writes; auth.import_users accepts at most 1000 users per call.
+MAX_BATCH_WRITES = 500
+MAX_AUTH_IMPORT_USERS = 1000
+MAX_AUTH_LOOKUP_IDENTIFIERS = 100 # auth.get_users limit
+
+class ImportSummary(TypedDict):
+    users_imported: int
+    users_failed: Dict[str, str]
+    referrals_linked: int
+    accounts_created: int
+    deposits_made: int
+
+def load_records(path: str) -> List[Dict]:
+    """
+    Loads records from a CSV or JSONL file. The format is picked from the file extension.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="", encoding="utf-8") as f:
+        if extension == ".csv":
+            # Empty CSV cells are treated as missing values
+            return [{key: value for key, value in row.items() if value not in ("", None)} for row in csv.DictReader(f)]
+        if extension in (".jsonl", ".ndjson"):
+            return [json.loads(line) for line in f if line.strip()]
+    raise ValueError(f"Unsupported import file format - {extension} - expected .csv or .jsonl")
+
+def _parse_timestamp(value) -> Optional[datetime.datetime]:
+    """Parses an ISO formatted timestamp, assuming UTC when no timezone is given."""
+    if not value:
+        return None
+    timestamp = value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+
+class BatchedWriter:
+    """
+    Groups Firestore writes into batches, committing whenever a batch is full.
+    """
+    def __init__(self, batch_size: int = MAX_BATCH_WRITES):
+        if not 0 < batch_size <= MAX_BATCH_WRITES:
+            raise ValueError(f"Batch size must be between 1 and {MAX_BATCH_WRITES}, got {batch_size}")
+        self.batch_size = batch_size
+        self.batch = db.batch()
+        self.pending_writes = 0
+        self.total_writes = 0
+
+    def set(self, ref, data: Dict, merge: bool = False) -> None:
+        """Queues a set operation."""
+        self.batch.set(ref, data, merge=merge)
+        self._on_write()
+
+    def update(self, ref, updates: Dict) -> None:
+        """Queues an update operation."""
+        self.batch.update(ref, updates)
+        self._on_write()
+
+    def _on_write(self) -> None:
+        self.pending_writes += 1
+        if self.pending_writes >= self.batch_size:
+            self.commit()
+
+    def commit(self) -> None:
+        """Commits any pending writes."""
+        if not self.pending_writes:
+            return
+        self.batch.commit()
+        self.total_writes += self.pending_writes
+        logging.info(f"Committed batch of {self.pending_writes} writes ({self.total_writes} total).")
+        self.batch = db.batch()
+        self.pending_writes = 0
+
+class BulkImporter:
+    """
+    Imports users, referral links, trading accounts and initial deposits in bulk.
+
+    Users are created in Firebase Authentication with auth.import_users and all Firestore documents are written
+    in batches. Each account (including its initial deposit) is written once and each referrer's referrals list
+    is appended to once with ArrayUnion, regardless of how many users they referred.
+    """
+    def __init__(self, batch_size: int = MAX_BATCH_WRITES, auth_batch_size: int = MAX_AUTH_IMPORT_USERS,
+                 password_hash_rounds: int = 10000):
+        if not 0 < auth_batch_size <= MAX_AUTH_IMPORT_USERS:
+            raise ValueError(f"Auth batch size must be between 1 and {MAX_AUTH_IMPORT_USERS}, got {auth_batch_size}")
+        self.batch_size = batch_size
+        self.auth_batch_size = auth_batch_size
+        self.password_hash_rounds = password_hash_rounds
+
+    def _hash_password(self, password: str) -> tuple[bytes, bytes]:
+        """Hashes a plain text password with PBKDF2-SHA256 so it can be imported into Firebase Authentication."""
+        salt = os.urandom(16)
+        password_hash = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, self.password_hash_rounds)
+        return password_hash, salt
+
+    @staticmethod
+    def build_users(user_records: Iterable[Dict], referral_records: Iterable[Dict] = ()) -> List[User]:
+        """
+        Creates User instances from user records and applies referral links to them.
+
+        User records take `name`, `email` and optionally `id`, `referred_by` and `timestamp`.
+        Referral records take `referrer_id` and `user_id`, and override `referred_by` of the referred user.
+        """
+        users = [
+            User(name=record["name"], email=record["email"], id=record.get("id"),
+                 referred_by=record.get("referred_by"), timestamp=_parse_timestamp(record.get("timestamp")))
+            for record in user_records
+        ]
+        users_by_id = {user.id: user for user in users}
+        for record in referral_records:
+            user = users_by_id.get(record["user_id"])
+            if not user:
+                raise ValueError(f"Referral link for user - {record['user_id']} - who is not part of this import.")
+            user.referred_by = record["referrer_id"]
+        return users
+
+    @staticmethod
+    def validate_users(users: List[User]) -> None:
+        """
+        Ensures user ids and emails are unique within the import, since auth.import_users doesn't check email
+        uniqueness and overwrites users with the same uid.
+        """
+        seen_ids, seen_emails = set(), set()
+        for user in users:
+            email = user.email.lower()
+            if user.id in seen_ids:
+                raise ValueError(f"Duplicate user id - {user.id} - in import.")
+            if email in seen_emails:
+                raise ValueError(f"Duplicate email - {user.email} - in import.")
+            seen_ids.add(user.id)
+            seen_emails.add(email)
+
+    @staticmethod
+    def find_existing_auth_users(users: List[User]) -> tuple[set, Dict[str, str]]:
+        """
+        Looks up users already registered in Firebase Authentication.
+
+        Returns the ids of users registered with the same uid, which shouldn't be imported again as that would
+        overwrite their password, and the ids of users whose email belongs to another uid, mapped to the reason.
+        """
+        ids_by_email = {user.email.lower(): user.id for user in users}
+        user_ids = {user.id for user in users}
+        identifiers = [auth.UidIdentifier(user.id) for user in users] + [auth.EmailIdentifier(user.email) for user in users]
+        existing_ids, conflicts = set(), {}
+        for start in range(0, len(identifiers), MAX_AUTH_LOOKUP_IDENTIFIERS):
+            result = auth.get_users(identifiers[start:start + MAX_AUTH_LOOKUP_IDENTIFIERS])
+            for user_record in result.users:
+                user_id = ids_by_email.get((user_record.email or "").lower())
+                if user_id and user_id != user_record.uid:
+                    conflicts[user_id] = f"Email {user_record.email} is already registered to user {user_record.uid}."
+                elif user_record.uid in user_ids:
+                    existing_ids.add(user_record.uid)
+        for user_id in existing_ids:
+            logging.warning(f"User {user_id} is already registered, skipping their auth import.")
+        for user_id, reason in conflicts.items():
+            logging.error(f"Error importing user {user_id}: {reason}")
+        return existing_ids - set(conflicts), conflicts
+
+    def import_auth_users(self, users: List[User], passwords: Dict[str, str]) -> Dict[str, str]:
+        """
+        Creates the users in Firebase Authentication in batches.
+
+        Returns the ids of users that couldn't be imported, mapped to the reason.
+        """
+        failed = {}
+        hash_alg = auth.UserImportHash.pbkdf2_sha256(rounds=self.password_hash_rounds)
+        for start in range(0, len(users), self.auth_batch_size):
+            chunk = users[start:start + self.auth_batch_size]
+            import_records = []
+            for user in chunk:
+                password_hash, password_salt = None, None
+                if passwords.get(user.id):
+                    password_hash, password_salt = self._hash_password(passwords[user.id])
+                import_records.append(auth.ImportUserRecord(uid=user.id, email=user.email, display_name=user.name,
+                                                            password_hash=password_hash, password_salt=password_salt))
+            try:
+                result = auth.import_users(import_records, hash_alg=hash_alg)
+            except firebase_admin.exceptions.FirebaseError as e:
+                logging.error(f"Error importing users {start} to {start + len(chunk)}: {e}")
+                failed.update({user.id: str(e) for user in chunk})
+                continue
+
+            for error in result.errors:
+                failed[chunk[error.index].id] = error.reason
+                logging.error(f"Error importing user {chunk[error.index].name}: {error.reason}")
+            logging.info(f"Imported {result.success_count} of {len(chunk)} users into Firebase Authentication.")
+        return failed
+
+    @staticmethod
+    def validate_referrers(users: List[User]) -> None:
+        """
+        Ensures referrers outside the import already exist in Firestore, since appending to their referrals
+        list would otherwise create a partial user document.
+        """
+        user_ids = {user.id for user in users}
+        external_referrer_ids = {user.referred_by for user in users if user.referred_by and user.referred_by not in user_ids}
+        if not external_referrer_ids:
+            return
+        referrer_refs = [db.collection("users").document(referrer_id) for referrer_id in external_referrer_ids]
+        missing = [doc.id for doc in db.get_all(referrer_refs) if not doc.exists]
+        if missing:
+            raise ValueError(f"Referrers not found: {', '.join(missing)}")
+
+    def write_users(self, users: List[User], writer: BatchedWriter, failed_user_ids: Iterable[str] = ()) -> int:
+        """
+        Queues the user documents and appends referred users to their referrers' referrals lists.
+
+        Returns the number of referral links written.
+        """
+        failed_user_ids = set(failed_user_ids)
+        referrals: Dict[str, List[str]] = {}
+        for user in users:
+            if not user.referred_by:
+                continue
+            if user.referred_by in failed_user_ids:
+                logging.warning(f"Referrer {user.referred_by} of user {user.name} failed to import, referral link not written.")
+                continue
+            referrals.setdefault(user.referred_by, []).append(user.id)
+        referrals_linked = sum(len(referred_ids) for referred_ids in referrals.values())
+
+        for user in users:
+            user_data = user.to_dict()
+            # Leave out empty fields so re-importing an existing user doesn't wipe their referral links
+            if user.id in referrals:
+                user_data["referrals"] = firestore.ArrayUnion(user.referrals + referrals.pop(user.id))
+            elif not user.referrals:
+                del user_data["referrals"]
+            if not user.referred_by:
+                del user_data["referred_by"]
+            writer.set(user.get_firestore_ref(), user_data, merge=True)
+
+        for referrer_id, referred_ids in referrals.items():
+            writer.set(db.collection("users").document(referrer_id), {"referrals": firestore.ArrayUnion(referred_ids)}, merge=True)
+
+        return referrals_linked
+
+    @staticmethod
+    def build_account(record: Dict) -> Account:
+        """
+        Creates an Account instance from an account record.
+
+        Account records take `user_id` and `account_type`, and optionally `id`, `initial_deposit`, the fee
+        percentages and `timestamp`.
+        """
+        timestamp = _parse_timestamp(record.get("timestamp"))
+        account_type: AccountType = record["account_type"]
+        account = Account(record["user_id"], account_type, id=record.get("id"),
+                          management_fee_pct=float(record.get("management_fee_pct", 0.02)),
+                          trading_fee_pct=float(record.get("trading_fee_pct", 0.25)),
+                          upline_commission_pct=float(record.get("upline_commission_pct", 0.05)),
+                          timestamp=timestamp)
+        return account
+
+    @staticmethod
+    def validate_accounts(account_records: List[Dict], user_ids: Iterable[str]) -> None:
+        """
+        Ensures account records have a known account type, a valid initial deposit, aren't duplicated, and belong
+        to a user in the import or already in Firestore. Accounts that already exist in Firestore are rejected,
+        since importing them would overwrite their balance.
+        """
+        account_types = get_args(AccountType)
+        user_ids = set(user_ids)
+        seen = set()
+        for record in account_records:
+            key = (record["user_id"], record["account_type"])
+            if record["account_type"] not in account_types:
+                raise ValueError(f"Invalid account type - {record['account_type']} - for user - {record['user_id']}.")
+            initial_deposit = float(record.get("initial_deposit", 0.0))
+            if not math.isfinite(initial_deposit) or initial_deposit < 0:
+                raise ValueError(f"Invalid initial deposit of {record.get('initial_deposit')} for account {key[1]} of user {key[0]}.")
+            if key in seen:
+                raise ValueError(f"Duplicate account {key[1]} for user {key[0]}.")
+            seen.add(key)
+
+        external_user_ids = {user_id for user_id, _ in seen if user_id not in user_ids}
+        if external_user_ids:
+            user_refs = [db.collection("users").document(user_id) for user_id in external_user_ids]
+            missing = [doc.id for doc in db.get_all(user_refs) if not doc.exists]
+            if missing:
+                raise ValueError(f"Account owners not found: {', '.join(missing)}")
+
+        if seen:
+            account_refs = [db.collection("users").document(user_id).collection("accounts").document(account_type)
+                            for user_id, account_type in seen]
+            existing = [f"{doc.reference.parent.parent.id}/{doc.id}" for doc in db.get_all(account_refs) if doc.exists]
+            if existing:
+                raise ValueError(f"Accounts already exist: {', '.join(existing)}")
+
+    def write_accounts(self, account_records: Iterable[Dict], writer: BatchedWriter, skip_user_ids: Iterable[str] = ()) -> tuple[int, int]:
+        """
+        Queues the account documents and their initial deposit transactions. Records should be checked with
+        validate_accounts first.
+
+        Returns the number of accounts and deposits written.
+        """
+        skip_user_ids = set(skip_user_ids)
+        accounts_created, deposits_made = 0, 0
+        for record in account_records:
+            if record["user_id"] in skip_user_ids:
+                logging.warning(f"Skipping account {record['account_type']} for user {record['user_id']} who failed to import.")
+                continue
+
+            account = self.build_account(record)
+            initial_deposit = float(record.get("initial_deposit", 0.0))
+            if initial_deposit:
+                transaction = Transaction(account.user_id, account.account_type, transaction_type="deposit",
+                                          amount=initial_deposit, prev_balance=account.balance,
+                                          new_balance=account.balance + initial_deposit,
+                                          description=f"Made a ${initial_deposit} deposit.", timestamp=account.timestamp)
+                writer.set(transaction.get_firestore_ref(), transaction.to_dict(), merge=True)
+                account.update_recent_activities(transaction.to_activity())
+                account.balance = transaction.new_balance
+                account.total_deposits += initial_deposit
+                deposits_made += 1
+
+            writer.set(account.get_firestore_ref(), account.to_dict(), merge=True)
+            accounts_created += 1
+        return accounts_created, deposits_made
+
+    def run(self, users_path: str, accounts_path: Optional[str] = None, referrals_path: Optional[str] = None) -> ImportSummary:
+        """
+        Imports users, referral links and accounts from CSV/JSONL files.
+
+        User records may carry a plain text `password`; users without one are created without a password.
+        Users already registered with the same id aren't imported into Firebase Authentication again, and users
+        whose email is registered to another id are reported as failed.
+        """
+        user_records = load_records(users_path)
+        referral_records = load_records(referrals_path) if referrals_path else []
+        account_records = load_records(accounts_path) if accounts_path else []
+
+        users = self.build_users(user_records, referral_records)
+        self.validate_users(users)
+        self.validate_referrers(users)
+        self.validate_accounts(account_records, (user.id for user in users))
+        passwords = {user.id: record.get("password") for user, record in zip(users, user_records)}
+
+        # Users already registered keep their auth record; only their Firestore documents are written
+        existing_ids, failed = self.find_existing_auth_users(users)
+        new_users = [user for user in users if user.id not in existing_ids and user.id not in failed]
+        failed.update(self.import_auth_users(new_users, passwords))
+        imported_users = [user for user in users if user.id not in failed]
+
+        writer = BatchedWriter(self.batch_size)
+        referrals_linked = self.write_users(imported_users, writer, failed_user_ids=failed)
+        accounts_created, deposits_made = self.write_accounts(account_records, writer, skip_user_ids=failed)
+        writer.commit()
+
+        logging.info(f"Bulk import done: {len(imported_users)} users, {referrals_linked} referrals, "
+                     f"{accounts_created} accounts, {deposits_made} deposits, {len(failed)} failed users.")
+        return {
+            "users_imported": len(imported_users),
+            "users_failed": failed,
+            "referrals_linked": referrals_linked,
+            "accounts_created": accounts_created,
+            "deposits_made": deposits_made,
+        }
@@ -8,6 +8,7 @@ import logging
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 import firebase_admin.exceptions
+from write_scheduler import WriteScheduler
 
 logging.basicConfig(filename="syftset_backend.log", 
                     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -21,6 +22,7 @@ db = firestore.client()
 
 # Define the AccountType type
 AccountType = Literal["main", "crypto-1", "forex-1"]
+MAX_RECENT_ACTIVITIES = 20
 TransactionType = Literal["deposit", "withdrawal", "trading_outcome", "referral_bonus", "upline_commission",
                           "management_fee", "trading_fee"]
 class AccountSessionData(TypedDict, total=False):  
@@ -62,8 +64,8 @@ class User:
             name=source["name"],
             email=source["email"],
             id=source["id"],
-            referred_by=source["referred_by"],
-            referrals=source["referrals"],
+            referred_by=source.get("referred_by"),
+            referrals=source.get("referrals"),
             timestamp=source["timestamp"]
         )
 
@@ -76,9 +78,13 @@ class User:
             raise ValueError(f"User with ID {user_id} not found.")
         return User.from_dict(user_doc.to_dict())
     
+    def get_firestore_ref(self):
+        """Returns the Firestore reference for the user."""
+        return db.collection("users").document(self.id)
+
     def save_to_firestore(self):
         """Saves the user instance to Firestore."""
-        user_ref = db.collection("users").document(self.id)
+        user_ref = self.get_firestore_ref()
         user_data = self.to_dict()
         
         user_ref.set(user_data, merge=True)
@@ -87,7 +93,7 @@ class User:
     def update_firestore_details(self, updates: Dict):
         """Updates specific fields for the user in Firestore."""
         # ToDo: use this for firestore updates
-        user_ref = db.collection("users").document(self.id)
+        user_ref = self.get_firestore_ref()
         
         user_ref.update(updates)
         logging.info(f"User {self.name} updated successfully in Firestore.")
@@ -121,23 +127,29 @@ class User:
         account = Account(self.id, account_type, management_fee_pct=management_fee_pct, \
                           trading_fee_pct=trading_fee_pct, upline_commission_pct=upline_commission_pct,
                          timestamp=timestamp)
+        # deposit() already persists the account, so only save here when there's no initial deposit
         if initial_deposit:
             account.deposit(initial_deposit, timestamp=timestamp)
-        account.save_to_firestore()
+        else:
+            account.save_to_firestore()
         logging.info(f"Trading account {account_type} created for user {self.name}.")
         return account
     
-    def refer(self, name: str, email: str, timestamp: Optional[datetime.datetime] = None) -> User:
+    def refer(self, name: str, email: str, timestamp: Optional[datetime.datetime] = None,
+              on_referred: Optional[Callable[[User], None]] = None) -> User:
         """
         Refers a new user, creates the referred user instance, and updates referrals list.
+        on_referred, if given, is called with the referred user once it has been saved (e.g. ReferralTree.add_user).
 
         Returns the referred user instance
         """
         referred_user = User(name=name, email=email, referred_by=self.id, timestamp=timestamp)
         self.referrals.append(referred_user.id)
-        self.update_firestore_details({"referrals": self.referrals})
+        self.update_firestore_details({"referrals": firestore.ArrayUnion([referred_user.id])})
         referred_user.save_to_firestore()
         logging.info(f"User {self.name} referred {referred_user.name}.")
+        if on_referred:
+            on_referred(referred_user)
         return referred_user 
      
 class Account:
@@ -166,6 +178,8 @@ class Account:
         self.total_trading_fee = total_trading_fee
         self.total_management_fee = total_management_fee
         self.recent_activities = recent_activities or []
+        self.unsaved_activities: List[Dict] = [] # newest first, added since the recent activities were last saved
+        self.last_session_data: Optional[AccountSessionData] = None # performance of the last session credited to this account
         self.can_receive_referral_bonus = can_receive_referral_bonus # to check if a user can receive referral bonuse
         self.can_yield_referral_bonus = can_yield_referral_bonus # to check if user can give upline bonus from profits
         self.referral_earnings = referral_earnings
@@ -231,104 +245,202 @@ class Account:
             raise ValueError(f"Account - {account_type} - of user - {user_id} - not found.")
         return Account.from_dict(account_doc.to_dict())
 
-    def save_to_firestore(self) -> None:
-        """Saves the account to Firestore."""
-        account_ref = db.collection("users").document(self.user_id).collection("accounts").document(self.account_type)
+    def get_firestore_ref(self):
+        """Returns the Firestore reference for the account."""
+        return db.collection("users").document(self.user_id).collection("accounts").document(self.account_type)
+
+    def save_to_firestore(self, scheduler: Optional[WriteScheduler] = None) -> None:
+        """Saves the account to Firestore, through the write scheduler if one is given."""
+        account_ref = self.get_firestore_ref()
 
         account_data = self.to_dict()
         
+        if scheduler:
+            scheduler.set(account_ref, account_data, merge=True)
+            return
         account_ref.set(account_data, merge=True)
         logging.info(f"Account {self.account_type} for user {self.user_id} saved successfully.")
 
     def update_firestore_details(self, updates: Dict) -> None:
         """Updates specific fields for the account in Firestore."""
-        account_ref = db.collection("users").document(self.user_id).collection("accounts").document(self.account_type)
+        account_ref = self.get_firestore_ref()
 
         account_ref.update(updates)
         logging.info(f"Account - {self.account_type} - for user - {self.user_id} - updated successfully.")
 
     def update_recent_activities(self, activity: Dict) -> None:
         """Updates the recent activities for the account."""
-        max_recent_activities = 20
-        
         # Trim recent activities list if it exceeds the limit
-        if len(self.recent_activities) >= (max_recent_activities):
+        if len(self.recent_activities) >= (MAX_RECENT_ACTIVITIES):
             self.recent_activities.pop()
         
         self.recent_activities.insert(0, activity)
+        self.unsaved_activities.insert(0, activity)
+
+    @staticmethod
+    def _activity_key(activity: Dict) -> tuple:
+        # Older activities were stored without an id, so the description and timestamp also identify them
+        return (activity.get("id"), activity.get("activity_type"), activity.get("description"), activity.get("timestamp"))
+
+    def _merge_unsaved_activities(self, stored_activities: List[Dict]) -> List[Dict]:
+        """Prepends the unsaved activities to the stored recent activities, skipping any already stored."""
+        stored_keys = {self._activity_key(activity) for activity in stored_activities}
+        new_activities = [activity for activity in self.unsaved_activities if self._activity_key(activity) not in stored_keys]
+        return (new_activities + stored_activities)[:MAX_RECENT_ACTIVITIES]
+
+    @staticmethod
+    def schedule_recent_activities(accounts: List[Account], scheduler: WriteScheduler) -> None:
+        """
+        Saves the unsaved recent activities of the accounts through the write scheduler and flushes it.
+
+        The stored activities are read in one batched read, so each account gets a single coalesced update under
+        the scheduler's rate limit. Should be called after the scheduler has flushed the accounts' amount changes.
+        An activity logged by another worker between the read and the commit can drop out of the recent list;
+        its transaction record and balance change are unaffected.
+        """
+        accounts = [account for account in accounts if account.unsaved_activities]
+        if not accounts:
+            return
+        account_docs = {account_doc.reference.path: account_doc for account_doc in db.get_all([account.get_firestore_ref() for account in accounts])}
+        for account in accounts:
+            account_ref = account.get_firestore_ref()
+            account_doc = account_docs.get(account_ref.path)
+            if not account_doc or not account_doc.exists:
+                logging.warning(f"Account - {account.account_type} - of user - {account.user_id} - not found, recent activities not saved.")
+                continue
+            account.recent_activities = account._merge_unsaved_activities(account_doc.to_dict()["recent_activities"])
+            account.unsaved_activities = []
+            scheduler.update(account_ref, {"recent_activities": account.recent_activities})
+        scheduler.flush()
+
+    def _commit_changes(self, increments: Dict[str, float], scheduler: Optional[WriteScheduler] = None) -> None:
+        """
+        Applies changes to the account's amounts (e.g. from a settlement or fee run) without overwriting deposits
+        or withdrawals committed by other workers in the meantime. Only the changed fields are written.
+
+        Without a scheduler, the changes and unsaved recent activities are applied to the stored account inside a
+        Firestore transaction. With a scheduler, the amounts are written as increments and the recent activities
+        must be saved with schedule_recent_activities once the scheduler is flushed.
+        """
+        account_ref = self.get_firestore_ref()
+        if scheduler:
+            scheduler.update(account_ref, {field: firestore.Increment(value) for field, value in increments.items()})
+            return
+
+        @firestore.transactional
+        def apply_changes(db_transaction) -> Dict:
+            account_doc = account_ref.get(transaction=db_transaction)
+            if not account_doc.exists:
+                raise ValueError(f"Account - {self.account_type} - of user - {self.user_id} - not found.")
+            account_data = account_doc.to_dict()
+            updates = {field: account_data[field] + value for field, value in increments.items()}
+            updates["recent_activities"] = self._merge_unsaved_activities(account_data["recent_activities"])
+            db_transaction.update(account_ref, updates)
+            return updates
+
+        # sync the local instance with the committed values
+        for field, value in apply_changes(db.transaction()).items():
+            setattr(self, field, value)
+        self.unsaved_activities = []
+        logging.info(f"Account - {self.account_type} - for user - {self.user_id} - updated successfully.")
         
+    def _commit_balance_change(self, transaction_type: TransactionType, amount: Optional[float], describe: Callable[[float], str],
+            balance_field: str, total_field: str, balance_label: str, timestamp: Optional[datetime.datetime] = None) -> Optional[Transaction]:
+        """
+        Atomically applies a deposit or withdrawal to the account and saves its transaction record.
+        An amount of None withdraws the entire stored balance, and does nothing if there is no balance.
+
+        The account is read inside a Firestore transaction, so concurrent deposits and withdrawals from other workers
+        are never lost, and withdrawals are checked against the stored balance rather than this instance's copy.
+        """
+        if amount is not None and not amount > 0:
+            raise ValueError(f"{transaction_type.capitalize()} amount must be positive, got ${amount}")
+        account_ref = self.get_firestore_ref()
+        # Keep the id and timestamp fixed so a retried attempt writes the same transaction record
+        transaction_id = str(uuid.uuid4())
+        timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+
+        @firestore.transactional
+        def apply_change(db_transaction) -> tuple[Account, Optional[Transaction]]:
+            account_doc = account_ref.get(transaction=db_transaction)
+            # Accounts not saved yet (e.g. an initial deposit in create_trading_account) are created by this transaction
+            account = Account.from_dict(account_doc.to_dict()) if account_doc.exists else Account.from_dict(self.to_dict())
+
+            prev_balance = getattr(account, balance_field)
+            change_amount = prev_balance if amount is None else amount
+            if not change_amount > 0:
+                return account, None
+            change = change_amount if transaction_type == "deposit" else -change_amount
+            if prev_balance + change < 0:
+                raise ValueError(f"Withdrawal amount of ${change_amount} exceeds {balance_label} of ${prev_balance}")
+
+            transaction = Transaction(self.user_id, self.account_type, transaction_type=transaction_type, amount=change_amount,
+                                      prev_balance=prev_balance, new_balance=prev_balance + change, id=transaction_id,
+                                      description=describe(change_amount), timestamp=timestamp)
+            account.update_recent_activities(transaction.to_activity())
+            setattr(account, balance_field, transaction.new_balance)
+            setattr(account, total_field, getattr(account, total_field) + change_amount)
+
+            db_transaction.set(transaction.get_firestore_ref(), transaction.to_dict())
+            if account_doc.exists:
+                db_transaction.update(account_ref, {
+                    balance_field: getattr(account, balance_field),
+                    total_field: getattr(account, total_field),
+                    "recent_activities": account.recent_activities,
+                })
+            else:
+                db_transaction.set(account_ref, account.to_dict())
+            return account, transaction
+
+        account, transaction = apply_change(db.transaction())
+        if not transaction:
+            logging.info(f"No {balance_label} to withdraw from account {self.account_type} of user {self.user_id}.")
+            return None
+
+        # sync the local instance with the committed values
+        for field in (balance_field, total_field, "recent_activities"):
+            setattr(self, field, getattr(account, field))
+        logging.info(f"{transaction_type.capitalize()} of ${transaction.amount} committed for account {self.account_type} of user {self.user_id}.")
+        return transaction
+
     def deposit(self, amount: float, description: Optional[str]=None, timestamp: Optional[datetime.datetime] = None):
         """
         Handles deposits to the account, updates balance, and logs a transaction.
         """
-        description = description or f"Made a ${amount} deposit."
-        new_balance = self.balance + amount
-
-        # Add Transaction to firestore
-        transaction = Transaction.process_transaction(self.user_id, self.account_type, transaction_type="deposit", amount=amount, prev_balance=self.balance,
-                                  new_balance=new_balance, description=description, timestamp=timestamp)
-
-        self.update_recent_activities(transaction.to_activity())
-        self.balance = new_balance
-        self.total_deposits += amount
-
-        # save current account details to firestore
-        self.save_to_firestore()
+        describe = lambda amount: description or f"Made a ${amount} deposit."
+        self._commit_balance_change("deposit", amount, describe, balance_field="balance", total_field="total_deposits",
+                                    balance_label="account balance", timestamp=timestamp)
 
     def withdraw(self, amount: float, timestamp: Optional[datetime.datetime] = None):
         """
         Handles withdrawals from the account, updates balance, and logs a transaction.
         """
-        if self.balance < amount:
-            raise ValueError(f"Withdrawal amount of ${amount} exceeds account balance of ${self.balance}")
-            
-        description = f"Made a ${amount} withdrawal."
-        new_balance = self.balance - amount
-
-        # Add Transaction to firestore
-        transaction = Transaction.process_transaction(self.user_id, self.account_type, transaction_type="withdrawal", amount=amount, prev_balance=self.balance,
-                                  new_balance=new_balance, description=description, timestamp=timestamp)
-
-        self.update_recent_activities(transaction.to_activity())
-        self.balance = new_balance
-        self.total_withdrawals += amount
-
-        # save current account details to firestore
-        self.save_to_firestore()
+        self._commit_balance_change("withdrawal", amount, lambda amount: f"Made a ${amount} withdrawal.", balance_field="balance",
+                                    total_field="total_withdrawals", balance_label="account balance", timestamp=timestamp)
 
     def withdraw_from_referral_bonus(self, amount: float, timestamp: Optional[datetime.datetime] = None):
         """
         Handles withdrawals from the referral bonus balance and logs a transaction.
         """
-        if self.referral_earnings < amount:
-            raise ValueError(f"Withdrawal amount of ${amount} exceeds referral bonus balance of ${self.referral_earnings}")
-            
-        description = f"Made a ${amount} withdrawal from referral bonus balance."
-        new_balance = self.referral_earnings - amount
-
-        # Add Transaction to firestore
-        transaction = Transaction.process_transaction(self.user_id, self.account_type, transaction_type="withdrawal", amount=amount, prev_balance=self.referral_earnings,
-                                  new_balance=new_balance, description=description, timestamp=timestamp)
-
-        self.update_recent_activities(transaction.to_activity())
-        self.referral_earnings = new_balance
+        describe = lambda amount: f"Made a ${amount} withdrawal from referral bonus balance."
 
         # ToDo: Decide if withdrawal from referral bonus should affect total withdrawals
-        self.total_withdrawals += amount
-
-        # save current account details to firestore
-        self.save_to_firestore()
+        self._commit_balance_change("withdrawal", amount, describe, balance_field="referral_earnings",
+                                    total_field="total_withdrawals", balance_label="referral bonus balance", timestamp=timestamp)
 
     def close_account(self, timestamp: Optional[datetime.datetime] = None):
         """
         Closes the account by withdrawing the entire balance.
         """
-        amount = self.balance
-        self.withdraw(amount, timestamp=timestamp)
+        # The balance is read inside the withdrawal transaction, so deposits or withdrawals made by other workers are accounted for
+        self._commit_balance_change("withdrawal", None, lambda amount: f"Made a ${amount} withdrawal.", balance_field="balance",
+                                    total_field="total_withdrawals", balance_label="account balance", timestamp=timestamp)
 
-    def get_referrer_account(self, referrer: User, check_bonus_eligibility: bool = True) -> Optional[Account]:
+    def get_referrer_account(self, referrer: User, check_bonus_eligibility: bool = True,
+            referrer_accounts: Optional[Dict[str, Account]] = None) -> Optional[Account]:
         """
         Retrieves or creates the trading account of the same account type for the referrer and validates bonus eligibility. 
+        referrer_accounts, if given, caches the accounts by user id so a referrer's account is only read once per run.
         """
         if not referrer:
             return None
@@ -336,14 +448,19 @@ class Account:
         # Approach chosen here is that Referral Profits Go to Account instance, not user instance. If user A refers user B who opens account type A, bonus from
         # this account type A will go to user A's account A. If user A has no account A, it should be created for them.
         # This introduces users to different account types, which could lead to more engagement.
-        referrer_account = referrer.get_trading_account_from_firestore(self.account_type) or referrer.create_trading_account(self.account_type)
+        referrer_account = referrer_accounts.get(referrer.id) if referrer_accounts is not None else None
+        if not referrer_account:
+            referrer_account = referrer.get_trading_account_from_firestore(self.account_type) or referrer.create_trading_account(self.account_type)
+            if referrer_accounts is not None:
+                referrer_accounts[referrer.id] = referrer_account
 
         if check_bonus_eligibility:
             return referrer_account if self.can_yield_referral_bonus and referrer_account.can_receive_referral_bonus else None
 
         return referrer_account
     
-    def apply_referral_bonus(self, referrer_account: Account, upline_commission: float, user_name: str, referrer_name: str, session_number: int, session_id: str, timestamp: datetime.datetime):
+    def apply_referral_bonus(self, referrer_account: Account, upline_commission: float, user_name: str, referrer_name: str, session_number: int, session_id: str, timestamp: datetime.datetime,
+            scheduler: Optional[WriteScheduler] = None):
         """
         Applies the referral bonus to the referrer's account, logs the transaction,
         and updates the referrer's earnings.
@@ -359,16 +476,19 @@ class Account:
             prev_balance=referrer_account.total_referral_earnings,
             new_balance=new_balance,
             description=description,
-            timestamp=timestamp
+            timestamp=timestamp,
+            scheduler=scheduler
         )
         referrer_account.update_recent_activities(transaction.to_activity())
         referrer_account.total_referral_earnings += upline_commission
         referrer_account.referral_earnings += upline_commission
-        referrer_account.save_to_firestore()
+        # A big referrer's account is updated once per downline account; the scheduler coalesces these writes
+        referrer_account._commit_changes({"total_referral_earnings": upline_commission, "referral_earnings": upline_commission}, scheduler)
 
         # Log referrer's session records.
         referrer_session_details = AccountSessionDetails(session_number, referrer_account.account_type, referrer_account.user_id, timestamp=timestamp)
-        referrer_session_details.update_session_performance_records(referral_bonus=upline_commission, starting_balance=referrer_account.balance)
+        referrer_session_details.update_session_performance_records(referral_bonus=upline_commission, starting_balance=referrer_account.balance,
+                                                                    scheduler=scheduler, referral_bonus_only=True)
 
         # Log the upline commission for the current user
         upline_description = f"Session {session_number}: ${upline_commission} upline commission to {referrer_name}"
@@ -382,7 +502,8 @@ class Account:
             new_balance=new_upline_balance,
             id=session_id,
             description=upline_description,
-            timestamp=timestamp
+            timestamp=timestamp,
+            scheduler=scheduler
         )
         self.update_recent_activities(upline_transaction.to_activity())
         self.total_upline_commission += upline_commission
@@ -395,7 +516,8 @@ class Account:
         upline_commission = gross_pnl * self.upline_commission_pct if referrer_account else 0
         return trading_fee, upline_commission
 
-    def update_performance_metrics(self, session_number: int, session_id: str, net_pnl: float, trading_fee: float, timestamp: datetime.datetime):
+    def update_performance_metrics(self, session_number: int, session_id: str, net_pnl: float, trading_fee: float, timestamp: datetime.datetime,
+            scheduler: Optional[WriteScheduler] = None):
         """
         Updates the performance metrics and logs transactions for trading fees and session outcomes.
         """
@@ -410,7 +532,8 @@ class Account:
             new_balance=self.balance + net_pnl,
             id=session_id,
             description=session_description,
-            timestamp=timestamp
+            timestamp=timestamp,
+            scheduler=scheduler
         )
         self.update_recent_activities(roi_transaction.to_activity())
         self.balance += net_pnl
@@ -428,12 +551,14 @@ class Account:
                 new_balance=self.total_trading_fee + trading_fee,
                 id=session_id,
                 description=fee_description,
-                timestamp=timestamp
+                timestamp=timestamp,
+                scheduler=scheduler
             )
             self.update_recent_activities(trading_fee_transaction.to_activity())
             self.total_trading_fee += trading_fee
 
-    def distribute_profit_split(self, profit_percentage: float, session_number: int, user: Optional[User] = None, referrer: Optional[User] = None, timestamp: Optional[datetime.datetime]=None, get_account: Optional[Callable[[str], Optional[Account]]]=None):
+    def distribute_profit_split(self, profit_percentage: float, session_number: int, user: Optional[User] = None, referrer: Optional[User] = None, timestamp: Optional[datetime.datetime]=None, get_account: Optional[Callable[[str], Optional[Account]]]=None,
+            scheduler: Optional[WriteScheduler] = None, referrer_accounts: Optional[Dict[str, Account]] = None):
         """
         Main method to calculate the profit split, update balances, and handle referral bonuses.
         """
@@ -444,7 +569,7 @@ class Account:
         session_id = f"session_{session_number}"
 
         if profit_percentage > 0:
-            referrer_account = self.get_referrer_account(referrer)
+            referrer_account = self.get_referrer_account(referrer, referrer_accounts=referrer_accounts)
             
             # use referrer_account local instance if existing. This is to prevent unintended overwrites.
             if referrer_account and get_account:
@@ -454,21 +579,25 @@ class Account:
             net_pnl = gross_pnl - trading_fee - upline_commission
 
             if referrer_account:
-                self.apply_referral_bonus(referrer_account, upline_commission, user.name, referrer.name, session_number, session_id, timestamp)
+                self.apply_referral_bonus(referrer_account, upline_commission, user.name, referrer.name, session_number, session_id, timestamp, scheduler=scheduler)
 
         # update session_records before updating performance record. This is to capture starting balance before it is incremented
         session_details = AccountSessionDetails(session_number, self.account_type, self.user_id, timestamp=timestamp)
         session_details.update_session_performance_records(trading_fee=trading_fee, 
-            upline_commission=upline_commission, pnl=net_pnl, starting_balance=self.balance)
+            upline_commission=upline_commission, pnl=net_pnl, starting_balance=self.balance, scheduler=scheduler)
+        self.last_session_data = {"session_id": session_id, "starting_balance": self.balance, "pnl": net_pnl,
+                                  "trading_fee": trading_fee, "upline_commission": upline_commission}
         
         # update performance metrics
-        self.update_performance_metrics(session_number, session_id, net_pnl, trading_fee, timestamp)
-        self.save_to_firestore()
+        self.update_performance_metrics(session_number, session_id, net_pnl, trading_fee, timestamp, scheduler=scheduler)
+        self._commit_changes({"balance": net_pnl, "total_pnl": net_pnl, "total_trading_fee": trading_fee,
+                              "total_upline_commission": upline_commission}, scheduler)
 
-    def charge_management_fee(self, timestamp: Optional[datetime.datetime] = None) -> None:
+    def charge_management_fee(self, timestamp: Optional[datetime.datetime] = None, scheduler: Optional[WriteScheduler] = None) -> None:
         """
         Charges a management fee based on the account balance, updates metrics,
-        and logs the transaction to Firestore.
+        and logs the transaction to Firestore. Writes go through the scheduler if one is given; use
+        TradingSession.charge_management_fees to charge fees with a scheduler, as it also saves the recent activities.
         """
         management_fee = self.management_fee_pct * self.balance
         fee_description = f"Management fee deducted: ${management_fee}"
@@ -480,12 +609,13 @@ class Account:
             prev_balance=self.total_management_fee,
             new_balance=self.total_management_fee + management_fee,
             description=fee_description,
-            timestamp=timestamp
+            timestamp=timestamp,
+            scheduler=scheduler
         )
         self.update_recent_activities(management_fee_transaction.to_activity())
         self.balance -= management_fee
         self.total_management_fee += management_fee
-        self.save_to_firestore()
+        self._commit_changes({"balance": -management_fee, "total_management_fee": management_fee}, scheduler)
 
 class Transaction:
     """
@@ -525,13 +655,21 @@ class Transaction:
             "timestamp": self.timestamp,
         }
     
-    def save_to_firestore(self) -> None:
+    def get_firestore_ref(self):
+        """Returns the Firestore reference for the transaction."""
+        return db.collection("users").document(self.user_id).collection(
+            self.transaction_type).document(self.account_type).collection("entries").document(self.id)
+
+    def save_to_firestore(self, scheduler: Optional[WriteScheduler] = None) -> None:
         """
-        Saves the transaction to Firestore under the user's account transactions collection.
+        Saves the transaction to Firestore under the user's account transactions collection,
+        through the write scheduler if one is given.
         """
-        transaction_ref = db.collection("users").document(self.user_id).collection(
-            self.transaction_type).document(self.account_type).collection("entries").document(self.id)
+        transaction_ref = self.get_firestore_ref()
         transactions_data = self.to_dict()
+        if scheduler:
+            scheduler.set(transaction_ref, transactions_data, merge=True)
+            return
         transaction_ref.set(transactions_data, merge=True)
         logging.info(f"Transaction Added successfully. \nDetails:\nTransaction Type: {self.transaction_type}\nAmount: {self.amount}\
         \nUser Id: {self.user_id}\nAccount Type: {self.account_type}")
@@ -539,6 +677,7 @@ class Transaction:
     @staticmethod
     def process_transaction(user_id: str, account_type: AccountType, transaction_type: TransactionType, amount: float, prev_balance: float,
             new_balance: float, id: Optional[str] = None, description: str = "", timestamp: Optional[datetime.datetime] = None,
+            scheduler: Optional[WriteScheduler] = None,
         ) -> Transaction:
         """
         Creates and saves a transaction to Firebase.
@@ -554,7 +693,7 @@ class Transaction:
             description=description,
             timestamp=timestamp
         )
-        transaction.save_to_firestore()
+        transaction.save_to_firestore(scheduler)
         return transaction
     
     @staticmethod
@@ -585,6 +724,7 @@ class TradingSession:
                  btc_percentage_change: Optional[float] = None, eth_percentage_change: Optional[float] = None):
         self.users: List[User] = []
         self.accounts: List[Account] = []
+        self.referrer_accounts: Dict[str, Account] = {} # accounts by user id, shared across the session so each referrer account is read once
         self.account_type = account_type
         self.profit_percentage = profit_percentage
         self.session_number = session_number
@@ -658,17 +798,44 @@ class TradingSession:
 
         return account
 
-    def credit_profits(self) -> None:
+    def credit_profits(self, on_account_settled: Optional[Callable[[Account], None]] = None,
+                       scheduler: Optional[WriteScheduler] = None) -> None:
         """
         Credits profits to all accounts in the session.
+        on_account_settled, if given, is called with each account after it is credited (e.g. ReferralTree.update_account).
+        If a write scheduler is given, account and transaction writes go through it and are flushed at the end.
         """    
         if not len(self.accounts):
             self.populate_users_and_accounts()
+        for account in self.accounts:
+            self.referrer_accounts.setdefault(account.user_id, account)
             
         for account in self.accounts:
             user = self.get_user(account.user_id)
             referrer = self.get_user(user.referred_by) if user.referred_by else None
-            account.distribute_profit_split(self.profit_percentage, self.session_number, user, referrer, timestamp=self.end_date, get_account=self.get_session_account)
+            account.distribute_profit_split(self.profit_percentage, self.session_number, user, referrer, timestamp=self.end_date,
+                get_account=self.get_session_account, scheduler=scheduler, referrer_accounts=self.referrer_accounts)
+            if on_account_settled:
+                on_account_settled(account)
+
+        if scheduler:
+            scheduler.flush()
+            Account.schedule_recent_activities(list(self.referrer_accounts.values()), scheduler)
+
+    def charge_management_fees(self, scheduler: Optional[WriteScheduler] = None) -> None:
+        """
+        Charges the management fee on all accounts in the session.
+        If a write scheduler is given, writes go through it and are flushed at the end.
+        """
+        if not len(self.accounts):
+            self.populate_users_and_accounts()
+
+        for account in self.accounts:
+            account.charge_management_fee(timestamp=self.end_date, scheduler=scheduler)
+
+        if scheduler:
+            scheduler.flush()
+            Account.schedule_recent_activities(self.accounts, scheduler)
 
     def get_total_balance(self) -> float:
         """
@@ -718,6 +885,28 @@ class AccountSessionDetails:
         session_doc = session_ref.get()
         return session_doc.to_dict() if session_doc.exists else None
     
+    def _schedule_session_performance_records(self, session_ref, scheduler: WriteScheduler, trading_fee: float,
+            referral_bonus: float, upline_commission: float, pnl: float, starting_balance: float, referral_bonus_only: bool) -> None:
+        """
+        Writes session performance records through the write scheduler without reading the existing document.
+        Fields that aren't given are written as Increment(0), which initializes them to 0 on new documents and
+        leaves them unchanged on existing ones, so the referral bonuses of a big referrer coalesce into one write.
+
+        The starting balance is only written by the account's own settlement. A referrer credited earlier in the
+        session already has this session's pnl in their balance, so referral bonus writes leave it unchanged.
+        """
+        session_data = {
+            "id": self.id,
+            "timestamp": self.timestamp,
+            "referral_bonus": firestore.Increment(referral_bonus),  # Accumulates over time
+        }
+        if referral_bonus_only:
+            starting_balance = 0.0
+        for field, value in (("starting_balance", starting_balance), ("pnl", pnl), ("trading_fee", trading_fee),
+                             ("upline_commission", upline_commission)):
+            session_data[field] = value or firestore.Increment(0)
+        scheduler.set(session_ref, session_data, merge=True)
+
     def update_session_performance_records(
         self,
         trading_fee: float = 0.0,
@@ -725,12 +914,19 @@ class AccountSessionDetails:
         upline_commission: float = 0.0,
         pnl: float = 0.0,
         starting_balance: float = 0.0,
+        scheduler: Optional[WriteScheduler] = None,
+        referral_bonus_only: bool = False,
     ):
         """
         Updates session performance records in Firestore.
         If the session doesn't exist, it initializes a new record.
+        referral_bonus_only marks updates made for a referral bonus rather than the account's own settlement.
         """
         session_ref = self._get_session_ref()
+        if scheduler:
+            self._schedule_session_performance_records(session_ref, scheduler, trading_fee, referral_bonus,
+                                                       upline_commission, pnl, starting_balance, referral_bonus_only)
+            return
         existing_data = self._get_existing_session_data(session_ref)
 
         if not existing_data:
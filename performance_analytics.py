@@ -0,0 +1,248 @@
+from __future__ import annotations
+from typing import List, Dict, Set, Optional, Callable, TypedDict
+import math
+import logging
+import numpy as np
+
+from hedge_fund_models import db, Account, AccountType, AccountSessionData, TradingSession
+from write_scheduler import WriteScheduler
+
+class PerformanceMetrics(TypedDict):
+    sessions: int
+    cumulative_return: float
+    max_drawdown: float
+    volatility: Optional[float]
+    sharpe_ratio: Optional[float]
+    total_pnl: float
+    total_trading_fee: float
+    btc_excess_return: Optional[float]
+    eth_excess_return: Optional[float]
+
+def _session_number(session_id: str) -> int:
+    """Extracts the session number from a session id like session_12."""
+    return int(session_id.rsplit("_", 1)[-1])
+
+class AccountPerformance:
+    """
+    Performance of a single account over its trading sessions.
+
+    The session series is kept as arrays together with running totals (wealth, peak, drawdown, return moments and
+    benchmark wealth), so crediting a new session updates the metrics in O(1) instead of recomputing every session.
+    Sessions that started with no balance (e.g. accounts that only received referral bonuses) have no defined
+    return and only count towards the pnl and fee totals.
+    """
+    def __init__(self, user_id: str, account_type: AccountType, risk_free_rate: float = 0.0,
+                 periods_per_year: Optional[float] = None):
+        self.user_id = user_id
+        self.account_type = account_type
+        self.risk_free_rate = risk_free_rate # per session
+        self.periods_per_year = periods_per_year # to annualize volatility and Sharpe ratio, if given
+        self.session_ids: List[str] = [] # sessions with a defined return, in order
+        self.recorded_sessions: Set[str] = set() # every session added, including those that started with no balance
+        self.returns: List[float] = []
+        self.btc_changes: List[float] = [] # nan where the session has no benchmark data
+        self.eth_changes: List[float] = []
+
+        # running totals
+        self.total_pnl = 0.0
+        self.total_trading_fee = 0.0
+        self.wealth = 1.0
+        self.peak = 1.0
+        self.max_drawdown = 0.0
+        self.mean_return = 0.0
+        self.return_m2 = 0.0 # sum of squared deviations from the mean (Welford)
+        self.benchmark_wealth: Dict[str, List[float]] = {"btc": [1.0, 1.0], "eth": [1.0, 1.0]} # [strategy, benchmark]
+
+    @staticmethod
+    def from_sessions(user_id: str, account_type: AccountType, sessions: List[AccountSessionData],
+                      benchmarks: Dict[str, Dict], risk_free_rate: float = 0.0,
+                      periods_per_year: Optional[float] = None) -> AccountPerformance:
+        """
+        Builds the performance of an account from its session records, computing the metrics in vectorized form.
+        benchmarks maps session ids to the TradingSession data holding btc/eth_percentage_change.
+        """
+        performance = AccountPerformance(user_id, account_type, risk_free_rate, periods_per_year)
+        sessions = sorted(sessions, key=lambda session: _session_number(session["session_id"]))
+        performance.recorded_sessions = {session["session_id"] for session in sessions}
+        if not sessions:
+            return performance
+
+        starting_balance = np.array([session.get("starting_balance", 0.0) for session in sessions], dtype=float)
+        pnl = np.array([session.get("pnl", 0.0) for session in sessions], dtype=float)
+        trading_fee = np.array([session.get("trading_fee", 0.0) for session in sessions], dtype=float)
+        performance.total_pnl = float(pnl.sum())
+        performance.total_trading_fee = float(trading_fee.sum())
+
+        funded = starting_balance > 0
+        returns = pnl[funded] / starting_balance[funded]
+        session_ids = [session["session_id"] for session, is_funded in zip(sessions, funded) if is_funded]
+        changes = {
+            benchmark: np.array([benchmarks.get(session_id, {}).get(f"{benchmark}_percentage_change") for session_id in session_ids],
+                                dtype=float) # None becomes nan
+            for benchmark in ("btc", "eth")
+        }
+        performance.session_ids = session_ids
+        performance.returns = returns.tolist()
+        performance.btc_changes = changes["btc"].tolist()
+        performance.eth_changes = changes["eth"].tolist()
+        if not len(returns):
+            return performance
+
+        wealth = np.cumprod(1 + returns)
+        peaks = np.maximum.accumulate(np.concatenate(([1.0], wealth)))[1:]
+        performance.wealth = float(wealth[-1])
+        performance.peak = float(peaks[-1])
+        performance.max_drawdown = float(max(0.0, (1 - wealth / peaks).max()))
+        performance.mean_return = float(returns.mean())
+        performance.return_m2 = float(((returns - returns.mean()) ** 2).sum())
+
+        for benchmark, change in changes.items():
+            has_data = ~np.isnan(change)
+            performance.benchmark_wealth[benchmark] = [float(np.prod(1 + returns[has_data])), float(np.prod(1 + change[has_data]))]
+        return performance
+
+    def add_session(self, session: AccountSessionData, btc_percentage_change: Optional[float] = None,
+                    eth_percentage_change: Optional[float] = None) -> None:
+        """Adds a newly credited session, updating the metrics incrementally."""
+        if session["session_id"] in self.recorded_sessions:
+            logging.warning(f"Session {session['session_id']} already added for account {self.account_type} of user {self.user_id}.")
+            return
+        self.recorded_sessions.add(session["session_id"])
+        self.total_pnl += session.get("pnl", 0.0)
+        self.total_trading_fee += session.get("trading_fee", 0.0)
+
+        starting_balance = session.get("starting_balance", 0.0)
+        if starting_balance <= 0:
+            return
+        session_return = session.get("pnl", 0.0) / starting_balance
+        self.session_ids.append(session["session_id"])
+        self.returns.append(session_return)
+        self.btc_changes.append(math.nan if btc_percentage_change is None else btc_percentage_change)
+        self.eth_changes.append(math.nan if eth_percentage_change is None else eth_percentage_change)
+
+        self.wealth *= 1 + session_return
+        self.peak = max(self.peak, self.wealth)
+        self.max_drawdown = max(self.max_drawdown, 1 - self.wealth / self.peak)
+
+        delta = session_return - self.mean_return
+        self.mean_return += delta / len(self.returns)
+        self.return_m2 += delta * (session_return - self.mean_return)
+
+        for benchmark, change in (("btc", btc_percentage_change), ("eth", eth_percentage_change)):
+            if change is not None:
+                self.benchmark_wealth[benchmark][0] *= 1 + session_return
+                self.benchmark_wealth[benchmark][1] *= 1 + change
+
+    def get_series(self) -> Dict[str, np.ndarray]:
+        """Returns the session series of the account as arrays."""
+        returns = np.array(self.returns, dtype=float)
+        return {
+            "session_numbers": np.array([_session_number(session_id) for session_id in self.session_ids], dtype=int),
+            "returns": returns,
+            "cumulative_returns": np.cumprod(1 + returns) - 1,
+            "btc_percentage_change": np.array(self.btc_changes, dtype=float),
+            "eth_percentage_change": np.array(self.eth_changes, dtype=float),
+        }
+
+    def get_metrics(self) -> PerformanceMetrics:
+        """Returns the current performance metrics of the account."""
+        volatility, sharpe_ratio = None, None
+        if len(self.returns) > 1:
+            volatility = math.sqrt(self.return_m2 / (len(self.returns) - 1))
+            sharpe_ratio = (self.mean_return - self.risk_free_rate) / volatility if volatility else None
+            if self.periods_per_year:
+                volatility *= math.sqrt(self.periods_per_year)
+                sharpe_ratio = sharpe_ratio * math.sqrt(self.periods_per_year) if sharpe_ratio is not None else None
+
+        def excess_return(benchmark: str) -> Optional[float]:
+            if all(math.isnan(change) for change in getattr(self, f"{benchmark}_changes")):
+                return None
+            strategy_wealth, benchmark_wealth = self.benchmark_wealth[benchmark]
+            return strategy_wealth - benchmark_wealth
+
+        return {
+            "sessions": len(self.returns),
+            "cumulative_return": self.wealth - 1,
+            "max_drawdown": self.max_drawdown,
+            "volatility": volatility,
+            "sharpe_ratio": sharpe_ratio,
+            "total_pnl": self.total_pnl,
+            "total_trading_fee": self.total_trading_fee,
+            "btc_excess_return": excess_return("btc"),
+            "eth_excess_return": excess_return("eth"),
+        }
+
+    def save_to_firestore(self, scheduler: Optional[WriteScheduler] = None) -> None:
+        """Saves the current metrics to Firestore for the frontend to read, through the write scheduler if one is given."""
+        performance_ref = db.collection("users").document(self.user_id).collection("performance").document(self.account_type)
+        if scheduler:
+            scheduler.set(performance_ref, self.get_metrics(), merge=True)
+            return
+        performance_ref.set(self.get_metrics(), merge=True)
+        logging.info(f"Performance metrics of account {self.account_type} for user {self.user_id} saved successfully.")
+
+class PerformanceAnalytics:
+    """
+    Caches the performance of accounts and keeps it up to date as sessions are credited.
+    """
+    def __init__(self, risk_free_rate: float = 0.0, periods_per_year: Optional[float] = None):
+        self.risk_free_rate = risk_free_rate
+        self.periods_per_year = periods_per_year
+        self.accounts: Dict[tuple[str, str], AccountPerformance] = {}
+        self.benchmarks: Dict[str, Dict[str, Dict]] = {} # account_type -> session id -> session data
+
+    def _get_benchmarks(self, account_type: AccountType) -> Dict[str, Dict]:
+        """Retrieves the btc/eth changes of all trading sessions of the account type, once."""
+        if account_type not in self.benchmarks:
+            session_docs = db.collection("sessions").document(account_type).collection("entries").stream()
+            self.benchmarks[account_type] = {session_doc.id: session_doc.to_dict() for session_doc in session_docs}
+        return self.benchmarks[account_type]
+
+    def get_account_performance(self, user_id: str, account_type: AccountType,
+                                credited_session: Optional[AccountSessionData] = None) -> AccountPerformance:
+        """
+        Returns the cached performance of the account, building it from its session records on first use.
+        If given, credited_session replaces the stored record of the same session, which may have been written
+        before the session was credited (e.g. by a referral bonus) and miss the account's pnl.
+        """
+        key = (user_id, account_type)
+        if key not in self.accounts:
+            session_docs = db.collection("users").document(user_id).collection("sessions").document(account_type).collection("entries").stream()
+            sessions = [{**session_doc.to_dict(), "session_id": session_doc.id} for session_doc in session_docs]
+            if credited_session:
+                sessions = [session for session in sessions if session["session_id"] != credited_session["session_id"]]
+                sessions.append(credited_session)
+            self.accounts[key] = AccountPerformance.from_sessions(user_id, account_type, sessions, self._get_benchmarks(account_type),
+                                                                  self.risk_free_rate, self.periods_per_year)
+        return self.accounts[key]
+
+    def get_metrics(self, user_id: str, account_type: AccountType) -> PerformanceMetrics:
+        """Returns the performance metrics of the account."""
+        return self.get_account_performance(user_id, account_type).get_metrics()
+
+    def record_session(self, account: Account, session: TradingSession, save: bool = True,
+                       scheduler: Optional[WriteScheduler] = None) -> None:
+        """
+        Adds a credited session to the cached performance of the account, using the session performance the
+        account kept when it was credited (Account.last_session_data), so nothing is read back from Firestore.
+        Accounts not cached yet are built from their session records first.
+        """
+        session_data = account.last_session_data
+        if not session_data or session_data["session_id"] != session.id:
+            raise ValueError(f"Session {session.id} hasn't been credited to account {account.account_type} of user {account.user_id}.")
+
+        # The session may not be saved to Firestore yet, so its benchmark data is taken from the instance
+        self._get_benchmarks(account.account_type)[session.id] = session.to_dict()
+        performance = self.get_account_performance(account.user_id, account.account_type, session_data)
+        # Skipped if the performance was just built, as it then already includes the credited session
+        if session.id not in performance.recorded_sessions:
+            performance.add_session(session_data, session.btc_percentage_change, session.eth_percentage_change)
+        if save:
+            performance.save_to_firestore(scheduler)
+
+    def session_callback(self, session: TradingSession, scheduler: Optional[WriteScheduler] = None) -> Callable[[Account], None]:
+        """
+        Returns a callback for TradingSession.credit_profits' `on_account_settled` that records the session.
+        Pass the scheduler given to credit_profits so the metrics are saved with the settlement writes.
+        """
+        return lambda account: self.record_session(account, session, scheduler=scheduler)
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from typing import List, Dict, Optional, Iterable, TypedDict
+from array import array
+from collections import deque
+import logging
+
+from hedge_fund_models import db, User, Account, AccountType
+
+class DownlineSummary(TypedDict):
+    user_id: str
+    referrer_id: Optional[str]
+    direct_referrals: int
+    downline_size: int
+    downline_balance: float
+    downline_commissions: float
+
+class ReferralTree:
+    """
+    In-memory index of the referral tree with per-node subtree aggregates.
+
+    Users are mapped to integer nodes; the tree is kept as a parent array plus per-node child lists, and each node
+    stores the size, funded balance and upline commissions of its subtree. Aggregate queries are O(1), listing a
+    downline is O(subtree) and incremental updates are O(depth).
+    """
+    def __init__(self, account_type: Optional[AccountType] = None):
+        self.account_type = account_type # Aggregate only this account type, or every account type if None
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.parent = array("q")
+        self.children: List[List[int]] = []
+        self.subtree_size = array("q")
+        self.subtree_balance = array("d")
+        self.subtree_commissions = array("d")
+        self.own_balance = array("d")
+        self.own_commissions = array("d")
+        self.account_values: Dict[tuple[str, str], tuple[float, float]] = {} # (user_id, account_type) -> (balance, upline commission)
+        self.waiting_referrals: Dict[str, List[int]] = {} # referrer id not in the tree yet -> nodes they referred
+
+    def _get_or_add_node(self, user_id: str) -> int:
+        node = self.index.get(user_id)
+        if node is None:
+            node = len(self.ids)
+            self.index[user_id] = node
+            self.ids.append(user_id)
+            self.parent.append(-1)
+            self.children.append([])
+            self.subtree_size.append(1)
+            self.subtree_balance.append(0.0)
+            self.subtree_commissions.append(0.0)
+            self.own_balance.append(0.0)
+            self.own_commissions.append(0.0)
+            self._attach_waiting_referrals(node)
+        return node
+
+    def _attach_waiting_referrals(self, node: int) -> None:
+        """Attaches users that were added before their referrer to the referrer's newly added node."""
+        for child in self.waiting_referrals.pop(self.ids[node], []):
+            if self.parent[child] != -1:
+                continue
+            self.parent[child] = node
+            self.children[node].append(child)
+            # The new node has no ancestors yet, so only its own aggregates change
+            self.subtree_size[node] += self.subtree_size[child]
+            self.subtree_balance[node] += self.subtree_balance[child]
+            self.subtree_commissions[node] += self.subtree_commissions[child]
+
+    def _node(self, user_id: str) -> int:
+        node = self.index.get(user_id)
+        if node is None:
+            raise ValueError(f"User with ID {user_id} not found in referral tree.")
+        return node
+
+    def _ancestors(self, node: int, include_self: bool = True) -> Iterable[int]:
+        if not include_self:
+            node = self.parent[node]
+        while node != -1:
+            yield node
+            node = self.parent[node]
+
+    def _propagate(self, node: int, size: int = 0, balance: float = 0.0, commissions: float = 0.0) -> None:
+        """Adds the given deltas to the subtree aggregates of the node and all its ancestors."""
+        for ancestor in self._ancestors(node):
+            self.subtree_size[ancestor] += size
+            self.subtree_balance[ancestor] += balance
+            self.subtree_commissions[ancestor] += commissions
+
+    @staticmethod
+    def from_records(user_links: Iterable[tuple[str, Optional[str]]], accounts: Iterable[Account] = (),
+                     account_type: Optional[AccountType] = None) -> ReferralTree:
+        """
+        Builds the tree in a single pass from (user_id, referred_by) pairs and the users' accounts.
+
+        Users whose referrer isn't in user_links are treated as tree roots until the referrer is added, and links
+        that would form a cycle are dropped.
+        """
+        tree = ReferralTree(account_type)
+        links = list(user_links)
+        for user_id, _ in links:
+            tree._get_or_add_node(user_id)
+        for user_id, referred_by in links:
+            node = tree.index[user_id]
+            if referred_by in tree.index and referred_by != user_id:
+                tree.parent[node] = tree.index[referred_by]
+            elif referred_by and referred_by not in tree.index:
+                tree.waiting_referrals.setdefault(referred_by, []).append(node)
+
+        for account in accounts:
+            if account.user_id not in tree.index or (account_type and account.account_type != account_type):
+                continue
+            node = tree.index[account.user_id]
+            tree.account_values[(account.user_id, account.account_type)] = (account.balance, account.total_upline_commission)
+            tree.own_balance[node] += account.balance
+            tree.own_commissions[node] += account.total_upline_commission
+            tree.subtree_balance[node] += account.balance
+            tree.subtree_commissions[node] += account.total_upline_commission
+
+        tree._break_cycles()
+        for node, parent in enumerate(tree.parent):
+            if parent != -1:
+                tree.children[parent].append(node)
+
+        # Accumulate subtree aggregates bottom up by walking a top down order in reverse
+        order = [node for node, parent in enumerate(tree.parent) if parent == -1]
+        for node in order:
+            order.extend(tree.children[node])
+        for node in reversed(order):
+            parent = tree.parent[node]
+            if parent != -1:
+                tree.subtree_size[parent] += tree.subtree_size[node]
+                tree.subtree_balance[parent] += tree.subtree_balance[node]
+                tree.subtree_commissions[parent] += tree.subtree_commissions[node]
+
+        logging.info(f"Referral tree built with {len(tree.ids)} users.")
+        return tree
+
+    def _break_cycles(self) -> None:
+        """Detaches one link of every referral cycle so the tree has no cycles."""
+        state = bytearray(len(self.ids)) # 0: unvisited, 1: on current path, 2: done
+        for start in range(len(self.ids)):
+            path = []
+            node = start
+            while node != -1 and state[node] == 0:
+                state[node] = 1
+                path.append(node)
+                node = self.parent[node]
+            if node != -1 and state[node] == 1:
+                logging.warning(f"Referral cycle detected at user {self.ids[node]}, treating them as a root.")
+                self.parent[node] = -1
+            for visited in path:
+                state[visited] = 2
+
+    @staticmethod
+    def build_from_firestore(account_type: Optional[AccountType] = None) -> ReferralTree:
+        """
+        Builds the tree from one pass over the users collection and one collection group query over their accounts.
+        """
+        user_docs = db.collection("users").select(["referred_by"]).stream()
+        user_links = [(user_doc.id, (user_doc.to_dict() or {}).get("referred_by")) for user_doc in user_docs]
+
+        # Account documents are keyed by account type, so they're filtered here rather than with a where clause,
+        # which would need a collection group index
+        accounts = [Account.from_dict(account_doc.to_dict()) for account_doc in db.collection_group("accounts").stream()
+                    if not account_type or account_doc.id == account_type]
+
+        return ReferralTree.from_records(user_links, accounts, account_type)
+
+    def add_user(self, user: User) -> None:
+        """
+        Adds a newly referred or registered user to the tree. Can be passed as the `on_referred` callback of User.refer.
+        Users already in the tree (e.g. added as someone's referrer or as an account owner) get their referral link
+        attached, carrying their subtree aggregates up to their new ancestors.
+        """
+        node = self._get_or_add_node(user.id)
+        if not user.referred_by or self.parent[node] != -1:
+            return
+        parent = self._get_or_add_node(user.referred_by)
+        if node in self._ancestors(parent):
+            logging.warning(f"Referral of user {user.id} by {user.referred_by} would form a cycle, not linked.")
+            return
+        self.parent[node] = parent
+        self.children[parent].append(node)
+        self._propagate(parent, size=self.subtree_size[node], balance=self.subtree_balance[node],
+                        commissions=self.subtree_commissions[node])
+
+    def update_account(self, account: Account) -> None:
+        """
+        Applies the account's current balance and upline commission to the tree aggregates.
+        Can be passed as the `on_account_settled` callback of TradingSession.credit_profits.
+        """
+        if self.account_type and account.account_type != self.account_type:
+            return
+        node = self._get_or_add_node(account.user_id)
+        key = (account.user_id, account.account_type)
+        prev_balance, prev_commissions = self.account_values.get(key, (0.0, 0.0))
+        self.account_values[key] = (account.balance, account.total_upline_commission)
+        balance_change = account.balance - prev_balance
+        commissions_change = account.total_upline_commission - prev_commissions
+        self.own_balance[node] += balance_change
+        self.own_commissions[node] += commissions_change
+        self._propagate(node, balance=balance_change, commissions=commissions_change)
+
+    def downline(self, user_id: str, max_depth: Optional[int] = None) -> List[str]:
+        """
+        Returns the ids of users in the downline of the user, level by level, up to max_depth levels if given.
+        """
+        node = self._node(user_id)
+        downline = []
+        queue = deque((child, 1) for child in self.children[node])
+        while queue:
+            node, depth = queue.popleft()
+            downline.append(self.ids[node])
+            if max_depth is None or depth < max_depth:
+                queue.extend((child, depth + 1) for child in self.children[node])
+        return downline
+
+    def upline(self, user_id: str) -> List[str]:
+        """Returns the ids of the user's referrer, the referrer's referrer and so on."""
+        return [self.ids[node] for node in self._ancestors(self._node(user_id), include_self=False)]
+
+    def downline_size(self, user_id: str) -> int:
+        """Returns the number of users in the user's downline."""
+        return self.subtree_size[self._node(user_id)] - 1
+
+    def downline_balance(self, user_id: str) -> float:
+        """Returns the total account balance of the user's downline."""
+        node = self._node(user_id)
+        return self.subtree_balance[node] - self.own_balance[node]
+
+    def downline_commissions(self, user_id: str) -> float:
+        """Returns the total upline commissions generated by the user's downline."""
+        node = self._node(user_id)
+        return self.subtree_commissions[node] - self.own_commissions[node]
+
+    def get_summary(self, user_id: str) -> DownlineSummary:
+        """Returns the downline aggregates of the user."""
+        node = self._node(user_id)
+        parent = self.parent[node]
+        return {
+            "user_id": user_id,
+            "referrer_id": self.ids[parent] if parent != -1 else None,
+            "direct_referrals": len(self.children[node]),
+            "downline_size": self.downline_size(user_id),
+            "downline_balance": self.downline_balance(user_id),
+            "downline_commissions": self.downline_commissions(user_id),
+        }
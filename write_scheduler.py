@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import List, Dict, Optional, Literal, Callable
+import random
+import time
+import logging
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import transforms
+
+WriteOperation = Literal["set", "merge", "update"]
+
+# Errors raised when Firestore is throttling us or a hot document is contended. The commit is rejected in both
+# cases, so retrying is safe even for batches with increments. UNAVAILABLE isn't retried: the commit may have been
+# applied, and retrying it could apply the increments twice.
+RETRYABLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.Aborted)
+
+class TokenBucket:
+    """
+    Token bucket rate limiter whose rate adapts to Firestore's responses (additive increase, multiplicative decrease).
+    """
+    def __init__(self, rate: float, min_rate: float, max_rate: float, increase_step: float, decrease_factor: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate # tokens (writes) per second
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.tokens = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._last_refill = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        # Allow at most one second of burst
+        self.tokens = min(self.rate, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens: int) -> None:
+        """
+        Takes the given number of tokens, waiting for the bucket to cover them if it runs into debt.
+        Requests larger than the bucket are allowed so a full batch is never blocked forever at low rates.
+        """
+        self._refill()
+        self.tokens -= tokens
+        if self.tokens < 0:
+            self._sleep(-self.tokens / self.rate)
+
+    def on_success(self) -> None:
+        """Slowly raises the rate back towards the quota ceiling."""
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttled(self) -> None:
+        """Cuts the rate after a quota or contention error."""
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.tokens = min(self.tokens, 0.0)
+
+class WriteScheduler:
+    """
+    Schedules Firestore writes under an adaptive rate limit.
+
+    Writes to the same document within the coalescing window are merged into a single write, so hot documents
+    (like a big referrer's account during settlement) are written once per window instead of once per change.
+    Batches failing with RESOURCE_EXHAUSTED or ABORTED are retried with jittered exponential backoff
+    and lower the write rate.
+
+    Writes are only guaranteed to be committed after flush() returns.
+    """
+    def __init__(self, client, rate: float = 500.0, min_rate: float = 10.0, max_rate: float = 10000.0,
+                 increase_step: float = 50.0, coalesce_window: float = 1.0, batch_size: int = 500,
+                 max_retries: int = 8, base_delay: float = 0.5, max_delay: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        if not 0 < batch_size <= 500:
+            raise ValueError(f"Batch size must be between 1 and 500, got {batch_size}")
+        self.client = client
+        self.bucket = TokenBucket(rate, min_rate, max_rate, increase_step, clock=clock, sleep=sleep)
+        self.coalesce_window = coalesce_window
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._sleep = sleep
+        self.pending: Dict[str, tuple] = {} # document path -> (ref, operation, data)
+        self._window_start: Optional[float] = None
+        self.writes_requested = 0
+        self.writes_committed = 0
+
+    def set(self, ref, data: Dict, merge: bool = False) -> None:
+        """Schedules a set operation."""
+        self._schedule(ref, "merge" if merge else "set", data)
+
+    def update(self, ref, updates: Dict) -> None:
+        """Schedules an update operation."""
+        self._schedule(ref, "update", updates)
+
+    def _schedule(self, ref, operation: WriteOperation, data: Dict) -> None:
+        self.writes_requested += 1
+        if ref.path in self.pending:
+            _, pending_operation, pending_data = self.pending[ref.path]
+            # A plain set replaces the document, so nothing written before it survives
+            if operation != "set":
+                data = self._combine_data(pending_data, data)
+            operation = self._combine_operations(pending_operation, operation)
+        self.pending[ref.path] = (ref, operation, data)
+
+        now = self._clock()
+        if self._window_start is None:
+            self._window_start = now
+        elif now - self._window_start >= self.coalesce_window:
+            self.flush()
+
+    @staticmethod
+    def _combine_operations(earlier: WriteOperation, later: WriteOperation) -> WriteOperation:
+        # A plain set replaces the document, so its result stays a plain set whatever follows; a merge creates
+        # missing documents where an update wouldn't, so it wins over updates.
+        if "set" in (earlier, later):
+            return "set"
+        if "merge" in (earlier, later):
+            return "merge"
+        return "update"
+
+    @staticmethod
+    def _combine_data(earlier: Dict, later: Dict) -> Dict:
+        """Merges field values of two writes, accumulating increments and array unions."""
+        combined = dict(earlier)
+        for field, value in later.items():
+            previous = combined.get(field)
+            if isinstance(value, transforms.Increment) and isinstance(previous, transforms.Increment):
+                combined[field] = transforms.Increment(previous.value + value.value)
+            elif isinstance(value, transforms.Increment) and isinstance(previous, (int, float)) and not isinstance(previous, bool):
+                combined[field] = previous + value.value
+            elif isinstance(value, transforms.ArrayUnion) and isinstance(previous, transforms.ArrayUnion):
+                combined[field] = transforms.ArrayUnion(previous.values + value.values)
+            elif isinstance(value, transforms.ArrayUnion) and isinstance(previous, list):
+                combined[field] = previous + [item for item in value.values if item not in previous]
+            else:
+                combined[field] = value
+        return combined
+
+    def flush(self) -> None:
+        """
+        Commits all pending writes in rate limited batches. If a batch fails, it and the batches after it are kept
+        pending so a later flush can retry them.
+        """
+        writes = list(self.pending.values())
+        self.pending = {}
+        self._window_start = None
+        for start in range(0, len(writes), self.batch_size):
+            try:
+                self._commit_with_retry(writes[start:start + self.batch_size])
+            except Exception:
+                uncommitted = writes[start:]
+                self.pending = {ref.path: (ref, operation, data) for ref, operation, data in uncommitted}
+                self._window_start = self._clock()
+                logging.error(f"Flush failed, {len(uncommitted)} writes were not committed and are still pending.")
+                raise
+        if writes:
+            logging.info(f"Flushed {len(writes)} writes ({self.writes_requested} requested, {self.writes_committed} committed so far). "
+                         f"Write rate is {self.bucket.rate:.0f}/s.")
+
+    def _commit_with_retry(self, writes: List[tuple]) -> None:
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire(len(writes))
+            batch = self.client.batch()
+            for ref, operation, data in writes:
+                if operation == "update":
+                    batch.update(ref, data)
+                else:
+                    batch.set(ref, data, merge=operation == "merge")
+            try:
+                batch.commit()
+            except RETRYABLE_ERRORS as e:
+                self.bucket.on_throttled()
+                if attempt == self.max_retries:
+                    logging.error(f"Giving up on batch of {len(writes)} writes after {attempt + 1} attempts: {e}")
+                    raise
+                # Full jitter keeps workers that were throttled together from retrying together
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logging.warning(f"Batch of {len(writes)} writes throttled ({e}), retrying in {delay:.2f}s. "
+                                f"Write rate lowered to {self.bucket.rate:.0f}/s.")
+                self._sleep(delay)
+            else:
+                self.bucket.on_success()
+                self.writes_committed += len(writes)
+                return